@@ -3,6 +3,7 @@ from typing import Dict, List, Generator, Tuple
 import webbrowser
 import re
 import concurrent.futures
+import functools
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlencode, urlparse, urlunparse
 import json
@@ -31,6 +32,12 @@ logging.getLogger("urllib3").propagate = False
 CHARSET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~'
 LOCAL_PORT = 4721
 LOGIN_SCOPE = 'openid'
+# ElasticSearch offset pagination breaks down beyond this many records
+MAX_OFFSET_RESULTS = 10000
+# Number of search pages requested concurrently
+SEARCH_WORKERS = 8
+# Number of project files downloaded concurrently
+DOWNLOAD_WORKERS = 4
 
 AUTH_DETAILS = {
     "domain": "auth.riverscapes.net",
@@ -38,6 +45,22 @@ AUTH_DETAILS = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def _read_graphql(folder: str, name: str) -> str:
+    """ Read a GraphQL file once per process. Queries are loaded on every API call so
+    caching them avoids re-reading the same file from disk over and over.
+
+    Args:
+        folder (str): either 'queries' or 'mutations'
+        name (str): the file name without the .graphql extension
+
+    Returns:
+        str: the contents of the GraphQL file
+    """
+    with open(os.path.join(os.path.dirname(__file__), '..', '..', 'graphql', folder, f'{name}.graphql'), 'r', encoding='utf-8') as queryFile:
+        return queryFile.read()
+
+
 class RiverscapesAPIException(Exception):
     """Exception raised for errors in the RiverscapesAPI.
 
@@ -298,8 +321,7 @@ class RiverscapesAPI:
         Returns:
             str: _description_
         """
-        with open(os.path.join(os.path.dirname(__file__), '..', '..', 'graphql', 'queries', f'{query_name}.graphql'), 'r', encoding='utf-8') as queryFile:
-            return queryFile.read()
+        return _read_graphql('queries', query_name)
 
     def load_mutation(self, mutation_name: str) -> str:
         """ Load a mutation file from the file system.
@@ -310,8 +332,7 @@ class RiverscapesAPI:
         Returns:
             str: _description_
         """
-        with open(os.path.join(os.path.dirname(__file__), '..', '..', 'graphql', 'mutations', f'{mutation_name}.graphql'), 'r', encoding='utf-8') as queryFile:
-            return queryFile.read()
+        return _read_graphql('mutations', mutation_name)
 
     def get_project(self, project_id: str):
         """_summary_
@@ -360,6 +381,34 @@ class RiverscapesAPI:
         self.log.debug(f"Total records: {overall_total:,} .... starting retrieval...")
         if max_results and max_results > 0:
             self.log.debug(f"   ... but max_results is set to {max_results:,} so we will stop there.")
+
+        # Below the ElasticSearch pagination limit we can page by offset, which means we know every
+        # page up front and can request them all concurrently instead of one round-trip at a time
+        if overall_total <= MAX_OFFSET_RESULTS:
+            num_wanted = min(overall_total, max_results) if max_results and max_results > 0 else overall_total
+            offset_counter = 0
+            with concurrent.futures.ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+                pages = executor.map(lambda offset: self.run_query(qry, {"searchParams": search_params_gql, "limit": page_size, "offset": offset, "sort": sort}),
+                                     range(0, num_wanted, page_size))
+                for results in pages:
+                    for search_result in results['data']['searchProjects']['results']:
+                        if progress_bar:
+                            _prg.update(offset_counter)
+                        yield (RiverscapesProject(search_result['item']), stats, overall_total, _prg)
+                        offset_counter += 1
+                        if offset_counter >= num_wanted:
+                            break
+                    if offset_counter >= num_wanted:
+                        break
+
+            if max_results and max_results > 0 and offset_counter >= max_results:
+                self.log.warning(f"Max results reached: {max_results}. Stopping search.")
+            if progress_bar:
+                _prg.erase()
+                _prg.finish()
+            self.log.debug(f"Search complete: retrieved {offset_counter:,} records")
+            return
+
         # Set initial to and from dates so that we can paginate through more than 10,000 recirds
         now_date = datetime.now(timezone.utc)
         createdOn = search_params_gql.get('createdOn', {})
@@ -529,12 +578,14 @@ class RiverscapesAPI:
         stats = results['data']['searchProjects']['stats']
         return (total, stats)
 
-    def run_query(self, query, variables):
+    def run_query(self, query, variables, return_errors: bool = False):
         """ A simple function to use requests.post to make the API call. Note the json= section.
 
         Args:
             query (_type_): _description_
             variables (_type_): _description_
+            return_errors (bool, optional): Return the response, including its 'errors', instead of raising when
+                the query produces GraphQL errors alongside data (e.g. one aliased field failing). Defaults to False.
 
         Raises:
             Exception: _description_
@@ -556,7 +607,9 @@ class RiverscapesAPI:
                     self.log.debug("Authentication timed out. Fetching new token...")
                     self.refresh_token()
                     self.log.debug("   done. Re-trying query...")
-                    return self.run_query(query, variables)
+                    return self.run_query(query, variables, return_errors)
+                if return_errors is True and resp_json.get('data') is not None:
+                    return resp_json
                 raise RiverscapesAPIException(f"Query failed to run by returning code of {request.status_code}. ERRORS: {json.dumps(resp_json, indent=4, sort_keys=True)}")
             else:
                 # self.last_pass = True
@@ -565,27 +618,29 @@ class RiverscapesAPI:
         else:
             raise RiverscapesAPIException(f"Query failed to run by returning code of {request.status_code}. {query} {json.dumps(variables)}")
 
-    def download_files(self, project_id: str, download_dir: str, re_filter: List[str] = None, force=False):
+    def download_files(self, project_id: str, download_dir: str, re_filter: List[str] = None, force=False, max_workers: int = DOWNLOAD_WORKERS):
         """ From a project id get all relevant files and download them
 
         Args:
             project_id (_type_): _description_
             local_path (_type_): _description_
             force (bool, optional): _description_. Defaults to False.
+            max_workers (int, optional): Number of files to download concurrently. Defaults to DOWNLOAD_WORKERS.
         """
 
         # Fetch the project files from the API
         file_results = self.get_project_files(project_id)
 
         # Now filter the list of files to anything that remains after the regex filter
+        re_patterns = [re.compile(x, re.IGNORECASE) for x in re_filter] if re_filter is not None else []
         filtered_files = []
         for file in file_results:
             if not 'localPath' in file:
                 self.log.warning('File has no localPath. Skipping')
                 continue
             # now filter the
-            if re_filter is not None and len(re_filter) > 0:
-                if not any([re.compile(x, re.IGNORECASE).match(file['localPath'], ) for x in re_filter]):
+            if len(re_patterns) > 0:
+                if not any(pattern.match(file['localPath']) for pattern in re_patterns):
                     continue
             filtered_files.append(file)
 
@@ -593,11 +648,21 @@ class RiverscapesAPI:
             self.log.warning(f"No files found for project {project_id} with the given filters: {re_filter}")
             return
 
-        for file in filtered_files:
-            local_file_path = os.path.join(download_dir, file['localPath'])
-            self.download_file(file, local_file_path, force)
+        local_paths = [os.path.join(download_dir, file['localPath']) for file in filtered_files]
+
+        # Create each folder once up front so the download threads don't race to make them
+        for file_directory in {os.path.dirname(local_path) for local_path in local_paths}:
+            if len(file_directory) >= 5 and not os.path.exists(file_directory):
+                safe_makedirs(file_directory)
 
-    def download_file(self, api_file_obj: Dict[str, any], local_path: str, force=False):
+        # Per-file progress bars would overwrite each other when downloading concurrently
+        progress_bar = max_workers <= 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.download_file, file, local_path, force, progress_bar) for file, local_path in zip(filtered_files, local_paths)]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+    def download_file(self, api_file_obj: Dict[str, any], local_path: str, force=False, progress_bar: bool = True):
         """ NOTE: The directory for this file will be created if it doesn't exist
 
         Arguments:
@@ -606,9 +671,12 @@ class RiverscapesAPI:
 
         Keyword Arguments:
             force {bool} -- if true we will download regardless
+            progress_bar {bool} -- if true show a progress bar while downloading
         """
         file_is_there = os.path.exists(local_path) and os.path.isfile(local_path)
-        etag_match = file_is_there and calculate_etag(local_path) == api_file_obj['etag']
+        # Comparing sizes is much cheaper than hashing the whole file so only calculate the etag when they agree
+        size_match = file_is_there and (api_file_obj.get('size') is None or os.path.getsize(local_path) == int(api_file_obj['size']))
+        etag_match = size_match and calculate_etag(local_path) == api_file_obj['etag']
 
         file_directory = os.path.dirname(local_path)
 
@@ -629,8 +697,9 @@ class RiverscapesAPI:
 
             dl = 0
             with open(local_path, 'wb') as f:
-                if total_length is None:  # no content length header
-                    f.write(r.content)
+                if total_length is None or not progress_bar:  # no content length header or no progress wanted
+                    for data in r.iter_content(chunk_size=4096):
+                        f.write(data)
                 else:
                     progbar = ProgressBar(int(total_length), 50, local_path, byte_format=True)
                     for data in r.iter_content(chunk_size=4096):
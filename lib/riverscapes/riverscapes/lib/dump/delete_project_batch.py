@@ -15,19 +15,40 @@ WHERE project_id IN (SELECT project_id
 
 """
 
-from typing import List
+from typing import Dict, Iterable, Generator, List, Tuple
+from collections.abc import Sized
 import argparse
+import concurrent.futures
+import csv
+import itertools
+import os
 import sqlite3
 import inquirer
 from rsxml import dotenv
 from riverscapes import RiverscapesAPI
 
+# Number of deletions sent to the API at once
+DELETE_WORKERS = 4
+# Number of projects deleted by each aliased mutation request
+DELETE_BATCH_SIZE = 50
 
-def delete_project_batch(rs_api: RiverscapesAPI, stage: str, db_path: str, project_ids: List[str]) -> None:
+
+class DeleteBatchException(Exception):
+    """Raised when a project in a batch fails. Carries the results of the rest of the batch"""
+
+    def __init__(self, results: List[Tuple[str, bool]], error: Exception):
+        super().__init__(str(error))
+        self.results = results
+        self.error = error
+
+
+def delete_project_batch(rs_api: RiverscapesAPI, stage: str, db_path: str, project_ids: Iterable[str]) -> None:
     """Delete a batch of projects from the Riverscapes API"""
 
+    num_projects = f'{len(project_ids)}' if isinstance(project_ids, Sized) else 'the listed'
+
     questions = [
-        inquirer.Confirm('continue', message=f'Delete {len(project_ids)} projects from {stage}?', default=False),
+        inquirer.Confirm('continue', message=f'Delete {num_projects} projects from {stage}?', default=False),
         inquirer.Text("confirm", message="type the word DELETE"),
         inquirer.Confirm("delete_local", message="Delete projects from local DB?", default=True),
         inquirer.Confirm("start_job", message="Start job?", default=False),
@@ -39,8 +60,9 @@ def delete_project_batch(rs_api: RiverscapesAPI, stage: str, db_path: str, proje
         print('Aborting')
         return
 
-    print(f'Deleting {len(project_ids)} projects from {stage}')
+    print(f'Deleting {num_projects} projects from {stage}')
 
+    conn = None
     if answers['delete_local'] is True:
         conn = sqlite3.connect(db_path) if answers['delete_local'] else None
         curs = conn.cursor()
@@ -48,39 +70,165 @@ def delete_project_batch(rs_api: RiverscapesAPI, stage: str, db_path: str, proje
 
     not_found = 0
     deleted = 0
+    for project_id, was_deleted in delete_projects(rs_api, project_ids):
+        if not was_deleted:
+            not_found += 1
+            continue
+
+        deleted += 1
+        if conn is not None:
+            # Commit as we go so the local DB reflects every deletion even if the batch is interrupted
+            curs.execute('DELETE FROM rs_projects WHERE project_id = ?', [project_id])
+            conn.commit()
+
+    print(f'Process complete. {deleted} projects deleted. {not_found} projects not found.')
+
+
+def delete_projects(rs_api: RiverscapesAPI, project_ids: Iterable[str], max_workers: int = DELETE_WORKERS, batch_size: int = DELETE_BATCH_SIZE) -> Generator[Tuple[str, bool], None, None]:
+    """Delete projects concurrently as they are read from project_ids
+
+    Projects are deleted batch_size at a time with a single aliased mutation per batch and only
+    a bounded number of batches are in flight at once so project_ids is still consumed lazily.
+
+    Yields:
+        Tuple[project_id: str, deleted: bool]: deleted is False if the project was not found or already deleted
+    """
+
     delete_qry = rs_api.load_mutation('deleteProject')
-    for project_id in project_ids:
+    id_iter = iter(project_ids)
+    first_error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        batch = list(itertools.islice(id_iter, batch_size))
+        while len(batch) > 0:
+            if len(pending) >= max_workers:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    results, error = batch_results(future)
+                    yield from results
+                    first_error = first_error or error
+                # Stop submitting new batches once one has failed
+                if first_error is not None:
+                    break
+            pending.add(executor.submit(delete_project_batch_mutation, rs_api, delete_qry, batch))
+            batch = list(itertools.islice(id_iter, batch_size))
+
+        # Report every batch still in flight, even after a failure, so all the deletions they make reach the caller
+        for future in concurrent.futures.as_completed(pending):
+            results, error = batch_results(future)
+            yield from results
+            first_error = first_error or error
+
+    if first_error is not None:
+        raise first_error
+
+
+def batch_results(future: concurrent.futures.Future) -> Tuple[List[Tuple[str, bool]], Exception]:
+    """Get the results of a completed batch, including the deletions it made before failing, and its error if it failed"""
+
+    try:
+        return future.result(), None
+    except DeleteBatchException as e:
+        return e.results, e.error
+    except Exception as e:
+        return [], e
+
+
+def delete_project_batch_mutation(rs_api: RiverscapesAPI, delete_qry: str, project_ids: List[str]) -> List[Tuple[str, bool]]:
+    """Delete several projects in one request by aliasing a deleteProject field for each of them
+
+    Returns a list of (project_id, deleted) tuples in the same order as project_ids
+    """
+
+    params = ['$options: EntityDeletionOptions']
+    fields = []
+    variables = {'options': {}}
+    for idx, project_id in enumerate(project_ids):
+        params.append(f'$projectId{idx}: ID!')
+        fields.append(f'd{idx}: deleteProject(projectId: $projectId{idx}, options: $options) {{ error ids message success }}')
+        variables[f'projectId{idx}'] = project_id
+    mutation = f'mutation deleteProjects({", ".join(params)}) {{\n  ' + '\n  '.join(fields) + '\n}'
+
+    # A GraphQL error on one alias (e.g. a project already deleted) doesn't stop the others so read the
+    # result of every alias from the response, matching each error to its alias through its path
+    result = rs_api.run_query(mutation, variables, return_errors=True)
+    alias_errors = {}
+    for error in result.get('errors', []):
+        path = error.get('path') or [None]
+        alias_errors[path[0]] = error.get('message')
+
+    results = []
+    batch_error = None
+    for idx, project_id in enumerate(project_ids):
+        alias = f'd{idx}'
         try:
-            result = rs_api.run_query(delete_qry, {'projectId': project_id, 'options': {}})
-            if result is None or result['data']['deleteProject']['error'] is not None:
-                raise Exception(result['data']['deleteProject']['error'])
+            if alias in alias_errors:
+                error = alias_errors[alias]
+                if error is not None and ('not found' in error or 'already deleted' in error):
+                    results.append((project_id, False))
+                else:
+                    # Anything else may be transient so give the project one more try on its own
+                    results.append(delete_project(rs_api, delete_qry, project_id))
             else:
-                deleted += 1
-                if answers['delete_local']:
-                    curs.execute('DELETE FROM rs_projects WHERE project_id = ?', [project_id])
+                results.append(check_delete_result(project_id, result['data'][alias]))
         except Exception as e:
-            if e is not None and ('not found' in str(e) or 'already deleted' in str(e)):
-                not_found += 1
-            else:
-                raise e
+            batch_error = batch_error or e
 
-    if conn is not None:
-        conn.commit()
+    # Report the deletions that did succeed along with the failure so the local DB still gets updated for them
+    if batch_error is not None:
+        raise DeleteBatchException(results, batch_error) from batch_error
 
-    print(f'Process complete. {deleted} projects deleted. {not_found} projects not found.')
+    return results
+
+
+def delete_project(rs_api: RiverscapesAPI, delete_qry: str, project_id: str) -> Tuple[str, bool]:
+    """Delete a single project. Returns the project id and False if it was not found or already deleted"""
+
+    try:
+        result = rs_api.run_query(delete_qry, {'projectId': project_id, 'options': {}})
+    except Exception as e:
+        if e is not None and ('not found' in str(e) or 'already deleted' in str(e)):
+            return project_id, False
+        raise e
+
+    return check_delete_result(project_id, result['data']['deleteProject'] if result is not None else None)
+
+
+def check_delete_result(project_id: str, delete_result: Dict) -> Tuple[str, bool]:
+    """Interpret the deleteProject payload for one project"""
+
+    if delete_result is None or delete_result['error'] is not None:
+        error = delete_result['error'] if delete_result is not None else None
+        if error is not None and ('not found' in str(error) or 'already deleted' in str(error)):
+            return project_id, False
+        raise Exception(error)
+
+    return project_id, True
+
+
+def read_project_ids(csv_path: str) -> Generator[str, None, None]:
+    """Stream project GUIDs from the first column of a CSV file without loading the whole file"""
+
+    with open(csv_path, 'r', encoding='utf-8', newline='') as fin:
+        for row in csv.reader(fin):
+            if len(row) > 0 and row[0].strip() != '' and row[0].strip() != 'project_id':
+                yield row[0].strip()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('stage', help='URL to the cybercastor API', type=str, default='production')
     parser.add_argument('db_path', help='Path to local SQLite warehouse dump', type=str)
-    parser.add_argument('project_ids', help='Comma separate list of project GUIDs to delete', type=str)
+    parser.add_argument('project_ids', help='Comma separate list of project GUIDs to delete, or path to a CSV file with GUIDs in the first column', type=str)
     args = dotenv.parse_args_env(parser)
 
-    project_list = args.project_ids.split(',')
+    if os.path.isfile(args.project_ids):
+        project_list = read_project_ids(args.project_ids)
+    else:
+        project_list = [project_id.strip() for project_id in args.project_ids.split(',') if project_id.strip() != '']
 
-    if len(project_list) == 0:
-        raise Exception('No project IDs provided to delete')
+        if len(project_list) == 0:
+            raise Exception('No project IDs provided to delete')
 
     with RiverscapesAPI(stage=args.stage) as api:
         delete_project_batch(api, args.stage, args.db_path, project_list)
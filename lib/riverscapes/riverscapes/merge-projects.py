@@ -9,15 +9,15 @@ Note:
 - the pipe character is used to separate the regexes.
 """
 from typing import Dict, Tuple, List
-from datetime import datetime
+from datetime import datetime, timezone
 import re
 import sys
 import os
 import logging
-import subprocess
 import json
 import argparse
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from osgeo import gdal, ogr
 import inquirer
 from rsxml import dotenv, Logger, safe_makedirs
@@ -41,6 +41,19 @@ name_lookup = {'RSContext': "RS Context",
                'rcat': "RCAT",
                'rs_metric_engine': "Metric Engine"}
 
+# Number of threads used to download and scan projects concurrently
+MAX_WORKERS = 8
+# Number of raster types merged at once. Each gdal.Warp is already multithreaded
+RASTER_WORKERS = 2
+# Number of polygons passed to each GEOS union call when merging project bounds
+UNION_CHUNK_SIZE = 100
+# Written into a project's download folder once all of its files have been downloaded
+DOWNLOAD_MARKER = '.download_complete'
+# Elements of a project.rs.xml file that scan_project reads
+SCAN_TAGS = frozenset({'Raster', 'DEM', 'Geopackage', 'ProjectBounds'})
+# File extensions of the datasets kept in the merged project.rs.xml
+_KEEP_EXT = frozenset({'gpkg', 'geojson', 'tif', 'tiff', 'log'})
+
 
 def merge_projects(projects_lookup: Dict[str, RiverscapesProject], merged_dir: str, name: str, project_type: str, collection_id: str, rs_stage: str, regex_list: List[str], delete_source: bool = False) -> None:
     """
@@ -54,18 +67,29 @@ def merge_projects(projects_lookup: Dict[str, RiverscapesProject], merged_dir: s
     project_vectors = {}
     bounds_geojson_files = []
 
-    first_project_xml = None
+    # Compile the file filters once rather than for every dataset in every project
+    regex_patterns = [re.compile(x, re.IGNORECASE) for x in regex_list]
+
+    project_xmls = []
     for proj_path, project in projects_lookup.items():
 
         project_xml = os.path.join(proj_path, 'project.rs.xml')
         if project_xml is None:
             log.warning(f'Skipping project with no project.rs.xml file {project["id"]}')
             continue
-        first_project_xml = project_xml
+        project_xmls.append(project_xml)
+    first_project_xml = project_xmls[-1] if len(project_xmls) > 0 else None
 
-        get_raster_datasets(project_xml, project_rasters, regex_list)
-        get_vector_datasets(project_xml, project_vectors, regex_list)
-        get_bounds_geojson_file(project_xml, bounds_geojson_files)
+    # Scan the project XML files concurrently, each into its own dictionaries, and then
+    # combine them in project order so the merge order does not depend on thread timing
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for scan_results in executor.map(lambda xml_path: scan_project_isolated(xml_path, regex_patterns), project_xmls):
+            merge_scan_results(scan_results, project_rasters, project_vectors, bounds_geojson_files)
+
+    # Source rasters are about to be deleted so the projects will need downloading again next time
+    if delete_source is True:
+        for proj_path in projects_lookup:
+            clear_project_downloaded(proj_path)
 
     process_rasters(project_rasters, merged_dir, delete_source=delete_source)
     process_vectors(project_vectors, merged_dir)
@@ -96,50 +120,105 @@ def merge_projects(projects_lookup: Dict[str, RiverscapesProject], merged_dir: s
 
     merged_project_xml = os.path.join(merged_dir, 'project.rs.xml')
     merge_project.write(merged_project_xml)
-    replace_log_file(merged_project_xml)
-    delete_unmerged_paths(merged_project_xml)
+    finalize_project_xml(merged_project_xml)
     log.info(f'Merged project.rs.xml file written to {merged_project_xml}')
 
 
-def delete_unmerged_paths(merged_project_xml):
+def finalize_project_xml(merged_project_xml) -> None:
     """
-    Reports, ShapeFiles and logs are not included in the merge.
-    Look for all elements called <Path> and remove their parents
+    Tidy up the merged project.rs.xml in a single parse and write:
+    Point all log files at the merged log file, and remove the parents of any
+    <Path> that is not a GeoPackage, raster or log because reports, ShapeFiles
+    etc. are not included in the merge.
     """
-    log = Logger('Delete')
+    log = Logger('Finalize')
 
-    # Load the XML file and search for any tag called Path
     tree = ET.parse(merged_project_xml)
-
-    # create a dictionary that maps from each element to its parent
     root = tree.getroot()
-    parent_map = {c: p for p in root.iter() for c in p}
-
-    for path_element in tree.findall('.//Path'):
-        file_ext = ['gpkg', 'geojson', 'tif', 'tiff', 'log']
-        matches = [ext for ext in file_ext if path_element.text.lower().endswith(ext)]
-        if len(matches) == 0:
-            log.info(f'Removing non GeoPackage, raster or log with contents {path_element.text}')
-            # Get and remove the parent of the Path element
-            parent = parent_map[path_element]
-            grandparent = parent_map[parent]
-            grandparent.remove(parent)
+
+    for log_file in root.findall('.//LogFile/Path'):
+        log_file.text = os.path.basename(log.instance.logpath)
+
+    # ElementTree has no parent pointers so rather than mapping every element to its parent,
+    # look down from each element at its children's <Path> and note which children to remove
+    removals = []
+    for grandparent in root.iter():
+        for parent in grandparent:
+            for path_element in parent.findall('Path'):
+                ext = path_element.text.rsplit('.', 1)[-1].lower()
+                if ext not in _KEEP_EXT:
+                    log.info(f'Removing non GeoPackage, raster or log with contents {path_element.text}')
+                    removals.append((grandparent, parent))
+                    break
+
+    # Remove the parents of the Path elements once the tree is no longer being iterated
+    for grandparent, parent in removals:
+        grandparent.remove(parent)
 
     tree.write(merged_project_xml)
 
 
-def replace_log_file(merged_project_xml) -> None:
+def cluster_polygons(geometries: List[ogr.Geometry]) -> List[List[int]]:
     """
-    Load the merged project.rs.xml and search for all occurences
-    of a log file and replace them with the merged log file
+    Partition geometries into groups whose envelopes overlap, either directly or
+    through other members of the group. Geometries in different groups cannot
+    intersect so each group can be unioned independently.
+    geometries: List - The geometries to partition
+    returns: List - Lists of indexes into geometries, one list per group
     """
 
-    log = Logger('Log')
+    # GetEnvelope returns (min_x, max_x, min_y, max_y)
+    envelopes = [geom.GetEnvelope() for geom in geometries]
+    parents = list(range(len(geometries)))
+
+    def find(idx: int) -> int:
+        while parents[idx] != idx:
+            parents[idx] = parents[parents[idx]]
+            idx = parents[idx]
+        return idx
+
+    # Sweep the envelopes from west to east, only comparing against those still open
+    active = []
+    for idx in sorted(range(len(envelopes)), key=lambda i: envelopes[i][0]):
+        min_x, _max_x, min_y, max_y = envelopes[idx]
+        active = [other for other in active if envelopes[other][1] >= min_x]
+        for other in active:
+            if envelopes[other][2] <= max_y and envelopes[other][3] >= min_y:
+                parents[find(other)] = find(idx)
+        active.append(idx)
+
+    clusters = {}
+    for idx in range(len(geometries)):
+        clusters.setdefault(find(idx), []).append(idx)
+
+    return list(clusters.values())
 
-    tree = ET.parse(merged_project_xml)
-    for log_file in tree.findall('.//LogFile/Path'):
-        log_file.text = os.path.basename(log.instance.logpath)
-    tree.write(merged_project_xml)
+
+def cascaded_union(geometries: List[ogr.Geometry], chunk_size: int = UNION_CHUNK_SIZE) -> ogr.Geometry:
+    """
+    Union polygons in chunks and then union the partial results. A single GEOS
+    union gets superlinearly slower with the number of inputs so keeping each
+    call to a moderate size is considerably faster for large project counts.
+    geometries: List - The Polygon or MultiPolygon geometries to union
+    chunk_size: int - Maximum number of geometries passed to each union call
+    returns: ogr.Geometry - The union of all the geometries
+    """
+
+    partial_unions = []
+    for start in range(0, len(geometries), chunk_size):
+        multi_polygon = ogr.Geometry(ogr.wkbMultiPolygon)
+        for geom in geometries[start:start + chunk_size]:
+            if ogr.GT_Flatten(geom.GetGeometryType()) == ogr.wkbMultiPolygon:
+                for part in range(geom.GetGeometryCount()):
+                    multi_polygon.AddGeometry(geom.GetGeometryRef(part))
+            else:
+                multi_polygon.AddGeometry(geom)
+        partial_unions.append(multi_polygon.UnionCascaded())
+
+    if len(partial_unions) > 1:
+        return cascaded_union(partial_unions, chunk_size)
+
+    return partial_unions[0] if len(partial_unions) > 0 else None
 
 
 def union_polygons(input_geojson_files, output_geojson_file) -> Tuple[str, str]:
@@ -153,48 +232,40 @@ def union_polygons(input_geojson_files, output_geojson_file) -> Tuple[str, str]:
         Tuple[str, str]: _description_
     """
 
-    # Create a new OGR memory data source
-    mem_driver = ogr.GetDriverByName('Memory')
-    mem_ds = mem_driver.CreateDataSource('')
+    # Read the bounds polygon straight from each GeoJSON file with OGR
+    geometries = []
+    for input_file in input_geojson_files:
+        input_ds = ogr.Open(input_file)
+        input_feature = input_ds.GetLayer(0).GetNextFeature()
+        geometries.append(input_feature.GetGeometryRef().Clone())
+        input_ds = None
 
-    # Create a new layer in the memory data source
-    mem_layer = mem_ds.CreateLayer('union', geom_type=ogr.wkbPolygon)
+    # Group the polygons into clusters whose envelopes overlap and union each cluster on its
+    # own. Clusters are disjoint so their unions can simply be collected together afterwards.
+    # A polygon whose envelope overlaps nothing else is already its own union so skip GEOS for it
+    cluster_unions = [geometries[cluster[0]] if len(cluster) == 1 else cascaded_union([geometries[idx] for idx in cluster])
+                      for cluster in cluster_polygons(geometries)]
 
-    # Iterate over input GeoJSON files
-    for input_file in input_geojson_files:
-        # Open the GeoJSON file
-        with open(input_file, 'r', encoding='utf8') as file:
-            geojson_data = json.load(file)
-
-        # Create an OGR feature and set its geometry
-
-        # Extract coordinates from the GeoJSON structure
-        coordinates = geojson_data['features'][0]['geometry']['coordinates']
-
-        # Create an OGR feature and set its geometry
-        feature_defn = mem_layer.GetLayerDefn()
-        feature = ogr.Feature(feature_defn)
-        geometry = ogr.CreateGeometryFromJson(json.dumps({
-            "type": "Polygon",
-            "coordinates": coordinates
-        }))
-        feature.SetGeometry(geometry)
-
-        # Add the feature to the layer
-        mem_layer.CreateFeature(feature)
-
-    # Perform the union operation on the layer
-    union_result = None
-    for feature in mem_layer:
-        if union_result is None:
-            union_result = feature.GetGeometryRef().Clone()
+    # Remove any donuts (typically slivers caused by rounding the individual Polygon extents)
+    polygons = []
+    for cluster_union in cluster_unions:
+        if ogr.GT_Flatten(cluster_union.GetGeometryType()) == ogr.wkbMultiPolygon:
+            polygons.extend(cluster_union.GetGeometryRef(part) for part in range(cluster_union.GetGeometryCount()))
         else:
-            union_result = union_result.Union(feature.GetGeometryRef())
+            polygons.append(cluster_union)
 
-    # Remove any donuts (typically slivers caused by rounding the individual Polygon extents)
-    clean_polygon = ogr.Geometry(ogr.wkbPolygon)
-    ring = union_result.GetGeometryRef(0)
-    clean_polygon.AddGeometry(ring)
+    clean_parts = []
+    for polygon in polygons:
+        clean_part = ogr.Geometry(ogr.wkbPolygon)
+        clean_part.AddGeometry(polygon.GetGeometryRef(0))
+        clean_parts.append(clean_part)
+
+    if len(clean_parts) == 1:
+        clean_polygon = clean_parts[0]
+    else:
+        clean_polygon = ogr.Geometry(ogr.wkbMultiPolygon)
+        for clean_part in clean_parts:
+            clean_polygon.AddGeometry(clean_part)
 
     # Get centroid coordinates
     centroid = clean_polygon.Centroid().GetPoint()
@@ -205,7 +276,7 @@ def union_polygons(input_geojson_files, output_geojson_file) -> Tuple[str, str]:
     # Create a new GeoJSON file for the union result
     output_driver = ogr.GetDriverByName('GeoJSON')
     output_ds = output_driver.CreateDataSource(output_geojson_file)
-    output_layer = output_ds.CreateLayer('union', geom_type=ogr.wkbPolygon)
+    output_layer = output_ds.CreateLayer('union', geom_type=clean_polygon.GetGeometryType())
 
     # Create a feature and set the geometry for the union result
     feature_defn = output_layer.GetLayerDefn()
@@ -216,61 +287,11 @@ def union_polygons(input_geojson_files, output_geojson_file) -> Tuple[str, str]:
     output_layer.CreateFeature(feature)
 
     # Clean up resources
-    mem_ds = None
     output_ds = None
 
     return centroid, bounding_rect
 
 
-def get_bounds_geojson_file(project_xml_path: str, bounds_files):
-    """
-    Get the GeoJSON file for the project bounds
-    project_xml_path: str - Path to the project.rs.xml file
-    bounds_files: List - List of GeoJSON files
-    """
-
-    tree = ET.parse(project_xml_path)
-    rel_path = tree.find('.//ProjectBounds/Path').text
-    abs_path = os.path.join(os.path.dirname(project_xml_path), rel_path)
-    if os.path.isfile(abs_path):
-        bounds_files.append(abs_path)
-
-
-def get_vector_datasets(project_xml_path: str, master_project: Dict, regex_list) -> None:
-    """
-    Discover all the vector datasets in the project.rs.xml file and incorporate them
-    intro the master project dictionary.
-    project: str - Path to the project.rs.xml file
-    master_project: Dict - The master list of GeoPackages and feature classes
-    """
-
-    log = Logger('Vectors')
-
-    tree = ET.parse(project_xml_path)
-    # find each geopackage in the project
-    for geopackage in tree.findall('.//Geopackage'):
-        gpkg_id = geopackage.attrib['id']
-        path = geopackage.find('Path').text
-        name = geopackage.find('Name').text
-
-        if not any([re.compile(x, re.IGNORECASE).match(path) for x in regex_list]):
-            log.info(f'Skipping non-regex raster {name} with path {path}')
-            continue
-
-        if (gpkg_id not in master_project):
-            master_project[gpkg_id] = {'rel_path': path, 'abs_path': os.path.join(os.path.dirname(project_xml_path), path), 'name': name, 'id': gpkg_id, 'layers': {}}
-
-        # find each layer in the geopackage
-        for layer in geopackage.findall('.//Vector'):
-            fc_name = layer.attrib['lyrName']
-            layer_name = layer.find('Name').text
-
-            if fc_name not in master_project[gpkg_id]['layers']:
-                master_project[gpkg_id]['layers'][fc_name] = {'fc_name': fc_name, 'name': layer_name, 'occurences': []}
-
-            master_project[gpkg_id]['layers'][fc_name]['occurences'].append({'path': os.path.join(os.path.dirname(project_xml_path), path)})
-
-
 def process_vectors(master_project: Dict, output_dir: str) -> None:
     """
     Process the vector datasets in the master project dictionary.  This will
@@ -287,86 +308,287 @@ def process_vectors(master_project: Dict, output_dir: str) -> None:
 
         # output GeoPackage
         output_gpkg = os.path.join(output_dir, gpkg_info['rel_path'])
-        output_gpkg_file = os.path.basename(output_gpkg)
-        output_gpkg_dir = os.path.dirname(output_gpkg)
-        safe_makedirs(output_gpkg_dir)
+        safe_makedirs(os.path.dirname(output_gpkg))
 
         if os.path.isfile(output_gpkg):
             os.remove(output_gpkg)
 
+        # Keep the output GeoPackage open for all the appends and defer building
+        # each spatial index until all the features have been written
+        output_ds = gdal.GetDriverByName('GPKG').Create(output_gpkg, 0, 0, 0, gdal.GDT_Unknown)
+
         for feature_class, feature_class_info in gpkg_info['layers'].items():
 
             for input_gpkg in feature_class_info['occurences']:
                 input_gpkg_file = input_gpkg['path']
-
-                # -nlt {geometry_type}
-                input_gpkg_file = input_gpkg['path']
-                cmd = f'ogr2ogr -f GPKG -makevalid -append  -nln {feature_class} "{output_gpkg_file}" "{input_gpkg_file}" {feature_class}'
-                log.debug(f'EXECUTING: {cmd}')
-                subprocess.call([cmd], shell=True, cwd=output_gpkg_dir)
+                log.debug(f'Appending {feature_class} from {input_gpkg_file}')
+                result = gdal.VectorTranslate(output_ds, input_gpkg_file,
+                                              accessMode='append',
+                                              layers=[feature_class],
+                                              layerName=feature_class,
+                                              makeValid=True,
+                                              layerCreationOptions=['SPATIAL_INDEX=NO'])
+                if result is None:
+                    log.warning(f'Failed to append {feature_class} from {input_gpkg_file}')
+
+            output_layer = output_ds.GetLayerByName(feature_class)
+            if output_layer is not None and output_layer.GetGeometryColumn():
+                log.debug(f'Building spatial index for {feature_class}')
+                index_result = output_ds.ExecuteSQL(f"SELECT CreateSpatialIndex('{feature_class}', '{output_layer.GetGeometryColumn()}')")
+                if index_result is not None:
+                    output_ds.ReleaseResultSet(index_result)
+
+        output_ds = None
 
 
 def process_rasters(master_project: Dict, output_dir: str, delete_source: bool = False) -> None:
     """
     Process the raster datasets in the master project dictionary.  This will
     merge all occurances of each type of raster into a single raster for each type.
+    Each type is independent so several are merged at once.
     master_project: Dict - The master list of rasters in the project
     output_dir: str - The top level output directory
     """
 
+    # Let GDAL decode the compressed source tiles with every core as well as the warp and output compression
+    gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+
+    with ThreadPoolExecutor(max_workers=RASTER_WORKERS) as executor:
+        futures = [executor.submit(merge_raster, raster_info, output_dir, delete_source) for raster_info in master_project.values()]
+        for future in as_completed(futures):
+            future.result()
+
+
+def merge_raster(raster_info: Dict, output_dir: str, delete_source: bool = False) -> None:
+    """
+    Merge all the occurances of a single type of raster into one output raster
+    raster_info: Dict - The master project entry for this type of raster
+    output_dir: str - The top level output directory
+    """
+
     log = Logger('Rasters')
+    log.info(f'Merging {len(raster_info["occurences"])} {raster_info["name"]} rasters.')
+
+    output_raster_path = os.path.join(output_dir, raster_info['path'])
+    safe_makedirs(os.path.dirname(output_raster_path))
+
+    raster = Raster(raster_info['occurences'][0]['path'])
+    integer_raster_enums = [gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_UInt32, gdal.GDT_Int16, gdal.GDT_Int32]
+    compression = f'COMPRESS={"DEFLATE" if raster.dataType in integer_raster_enums else "LZW"}'
+
+    input_rasters = [rp['path'] for rp in raster_info['occurences']]
 
-    for raster_info in master_project.values():
-        log.info(f'Merging {len(raster_info["occurences"])} {raster_info["name"]} rasters.')
+    # Mosaic in-process so GDAL can use tiled, multithreaded I/O and compression
+    log.debug(f'Warping {len(input_rasters)} rasters into {output_raster_path}')
+    gdal.Warp(output_raster_path, input_rasters,
+              format='GTiff',
+              creationOptions=[compression, 'TILED=YES', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER'],
+              warpOptions=['NUM_THREADS=ALL_CPUS'],
+              multithread=True,
+              resampleAlg='near',
+              dstNodata=raster.nodata)
 
-        output_raster_path = os.path.join(output_dir, raster_info['path'])
-        safe_makedirs(os.path.dirname(output_raster_path))
+    # Delete the source rasters to free up space
+    if delete_source is True:
+        for raster_path in input_rasters:
+            if os.path.isfile(raster_path):
+                log.info(f'Deleting source raster {raster_path}')
+                os.remove(raster_path)
 
-        raster = Raster(raster_info['occurences'][0]['path'])
-        integer_raster_enums = [gdal.GDT_Byte, gdal.GDT_UInt16, gdal.GDT_UInt32, gdal.GDT_Int16, gdal.GDT_Int32]
-        compression = f'COMPRESS={"DEFLATE" if raster.dataType in integer_raster_enums else "LZW"}'
-        no_data = f'-a_nodata {raster.nodata}' if raster.nodata is not None else ''
 
-        input_rasters = [f"\"{rp['path']}\"" for rp in raster_info['occurences']]
+def scan_project(project_xml_path: str, project_rasters: Dict, project_vectors: Dict, bounds_files: List[str], regex_patterns: List[re.Pattern]) -> None:
+    """
+    Discover all the rasters, GeoPackages and the project bounds GeoJSON in a
+    project.rs.xml file in a single streaming pass and incorporate them into the
+    master dictionaries. Only datasets whose path matches one of the regex_patterns are kept.
+    project_xml_path: str - Path to the project.rs.xml file
+    project_rasters: Dict - The master list of rasters across all projects
+    project_vectors: Dict - The master list of GeoPackages and feature classes
+    bounds_files: List - List of GeoJSON files
+    """
+
+    project_dir = os.path.dirname(project_xml_path)
+    bounds_found = False
+
+    # Detach every element from its parent as soon as it ends so only the chain of open elements is
+    # kept in memory. Elements inside a dataset are kept until the dataset itself has been consumed
+    open_elements = []
+    open_datasets = 0
+    for event, elem in ET.iterparse(project_xml_path, events=('start', 'end')):
+        if event == 'start':
+            open_elements.append(elem)
+            if elem.tag in SCAN_TAGS:
+                open_datasets += 1
+            continue
 
-        params = ['gdal_merge.py', '-o', f'"{output_raster_path}"', '-co', compression, no_data] + input_rasters
-        params_flat = ' '.join(params)
-        log.debug(f'EXECUTING: {params_flat}')
-        subprocess.call(params_flat, shell=True)
+        open_elements.pop()
+        if elem.tag in ('Raster', 'DEM'):
+            add_raster_dataset(elem, project_dir, project_rasters, regex_patterns)
+        elif elem.tag == 'Geopackage':
+            add_vector_dataset(elem, project_dir, project_vectors, regex_patterns)
+        elif elem.tag == 'ProjectBounds' and not bounds_found:
+            bounds_found = True
+            path_element = elem.find('Path')
+            if path_element is not None:
+                abs_path = os.path.join(project_dir, path_element.text)
+                if os.path.isfile(abs_path):
+                    bounds_files.append(abs_path)
+
+        if elem.tag in SCAN_TAGS:
+            open_datasets -= 1
+        if open_datasets == 0 and len(open_elements) > 0:
+            open_elements[-1].remove(elem)
+
+
+def scan_project_isolated(project_xml_path: str, regex_patterns: List[re.Pattern]) -> Tuple[Dict, Dict, List[str]]:
+    """
+    Scan a single project.rs.xml file into new dictionaries. This is safe to call
+    from worker threads because nothing is shared between calls.
+    project_xml_path: str - Path to the project.rs.xml file
+    returns: Tuple of the project rasters, vectors and bounds GeoJSON files
+    """
 
-        # Delete the source rasters to free up space
-        if delete_source is True:
-            for raster_path in input_rasters:
-                raster_path = raster_path[1:-1]  # remove the extra quotes
-                if os.path.isfile(raster_path):
-                    log.info(f'Deleting source raster {raster_path}')
-                    os.remove(raster_path)
+    rasters = {}
+    vectors = {}
+    bounds_files = []
+    scan_project(project_xml_path, rasters, vectors, bounds_files, regex_patterns)
+    return rasters, vectors, bounds_files
 
 
-def get_raster_datasets(project, master_project, regex_list: List[str]) -> None:
+def merge_scan_results(scan_results: Tuple[Dict, Dict, List[str]], project_rasters: Dict, project_vectors: Dict, bounds_files: List[str]) -> None:
     """
-    Discover all the rasters in the project.rs.xml file and incorporate them
-    intro the master project dictionary. If their path matches the regex_list
-    project: str - Path to the project.rs.xml file
+    Combine the output of scan_project_isolated for one project into the master dictionaries
+    scan_results: Tuple - The rasters, vectors and bounds GeoJSON files for one project
+    project_rasters: Dict - The master list of rasters across all projects
+    project_vectors: Dict - The master list of GeoPackages and feature classes
+    bounds_files: List - List of GeoJSON files
+    """
+
+    rasters, vectors, bounds = scan_results
+
+    for raster_id, raster_info in rasters.items():
+        if raster_id not in project_rasters:
+            project_rasters[raster_id] = {**raster_info, 'occurences': []}
+        # Rasters shared between projects (e.g. the same DEM tile) only need to be mosaicked once
+        occurences = project_rasters[raster_id]['occurences']
+        seen_paths = {occurence['path'] for occurence in occurences}
+        for occurence in raster_info['occurences']:
+            if occurence['path'] not in seen_paths:
+                seen_paths.add(occurence['path'])
+                occurences.append(occurence)
+
+    for gpkg_id, gpkg_info in vectors.items():
+        if gpkg_id not in project_vectors:
+            project_vectors[gpkg_id] = {**gpkg_info, 'layers': {}}
+        master_layers = project_vectors[gpkg_id]['layers']
+        for fc_name, layer_info in gpkg_info['layers'].items():
+            if fc_name not in master_layers:
+                master_layers[fc_name] = {**layer_info, 'occurences': []}
+            master_layers[fc_name]['occurences'].extend(layer_info['occurences'])
+
+    bounds_files.extend(bounds)
+
+
+def add_raster_dataset(raster: ET.Element, project_dir: str, master_project: Dict, regex_patterns: List[re.Pattern]) -> None:
+    """
+    Incorporate a single <Raster> or <DEM> element into the master project dictionary
+    if its path matches one of the regex_patterns
+    raster: ET.Element - The raster element from the project.rs.xml file
+    project_dir: str - Folder containing the project.rs.xml file
     master_project: Dict - The master list of rasters across all projects
     """
 
     log = Logger('Rasters')
 
-    tree = ET.parse(project)
-    rasters = tree.findall('.//Raster') + tree.findall('.//DEM')
-    for raster in rasters:
-        raster_id = raster.attrib['id']
-        path = raster.find('Path').text
-        name = raster.find('Name').text
+    raster_id = raster.attrib['id']
+    path = raster.find('Path').text
+    name = raster.find('Name').text
 
-        if not any([re.compile(x, re.IGNORECASE).match(path) for x in regex_list]):
-            log.info(f'Skipping non-regex raster {name} with path {path}')
-            continue
+    if not any(pattern.match(path) for pattern in regex_patterns):
+        log.info(f'Skipping non-regex raster {name} with path {path}')
+        return
+
+    if raster_id not in master_project:
+        master_project[raster_id] = {'path': path, 'name': name, 'id': raster_id, 'occurences': []}
+    master_project[raster_id]['occurences'].append({'path': os.path.realpath(os.path.join(project_dir, path))})
+
+
+def add_vector_dataset(geopackage: ET.Element, project_dir: str, master_project: Dict, regex_patterns: List[re.Pattern]) -> None:
+    """
+    Incorporate a single <Geopackage> element and its layers into the master project
+    dictionary if its path matches one of the regex_patterns
+    geopackage: ET.Element - The GeoPackage element from the project.rs.xml file
+    project_dir: str - Folder containing the project.rs.xml file
+    master_project: Dict - The master list of GeoPackages and feature classes
+    """
+
+    log = Logger('Vectors')
+
+    gpkg_id = geopackage.attrib['id']
+    path = geopackage.find('Path').text
+    name = geopackage.find('Name').text
+
+    if not any(pattern.match(path) for pattern in regex_patterns):
+        log.info(f'Skipping non-regex GeoPackage {name} with path {path}')
+        return
+
+    abs_path = os.path.join(project_dir, path)
+    if gpkg_id not in master_project:
+        master_project[gpkg_id] = {'rel_path': path, 'abs_path': abs_path, 'name': name, 'id': gpkg_id, 'layers': {}}
+
+    # find each layer in the geopackage
+    for layer in geopackage.findall('.//Vector'):
+        fc_name = layer.attrib['lyrName']
+        layer_name = layer.find('Name').text
+
+        if fc_name not in master_project[gpkg_id]['layers']:
+            master_project[gpkg_id]['layers'][fc_name] = {'fc_name': fc_name, 'name': layer_name, 'occurences': []}
+
+        master_project[gpkg_id]['layers'][fc_name]['occurences'].append({'path': abs_path})
+
+
+def project_is_downloaded(download_path: str, project: RiverscapesProject, file_regex_list: List[str]) -> bool:
+    """
+    Check whether a previous run finished downloading a project with the same file
+    regex list and the project has not been updated on the server since.
+    download_path: str - Local folder the project is downloaded into
+    project: RiverscapesProject - The project returned by the search
+    file_regex_list: List[str] - The file regexes being downloaded
+    """
 
-        if raster_id not in master_project:
-            master_project[raster_id] = {'path': path, 'name': name, 'id': raster_id, 'occurences': []}
-        master_project[raster_id]['occurences'].append({'path': os.path.join(os.path.dirname(project), path)})
+    marker_path = os.path.join(download_path, DOWNLOAD_MARKER)
+    if project.updated_date is None or not os.path.isfile(marker_path):
+        return False
+
+    with open(marker_path, 'r', encoding='utf-8') as marker_file:
+        if json.load(marker_file).get('file_regex_list') != file_regex_list:
+            return False
+
+    updated_date = project.updated_date if project.updated_date.tzinfo is not None else project.updated_date.replace(tzinfo=timezone.utc)
+    local_date = datetime.fromtimestamp(os.path.getmtime(marker_path), tz=timezone.utc)
+    return local_date >= updated_date
+
+
+def mark_project_downloaded(download_path: str, file_regex_list: List[str]) -> None:
+    """
+    Record that every file matching the file regex list has been downloaded for a project
+    download_path: str - Local folder the project was downloaded into
+    file_regex_list: List[str] - The file regexes that were downloaded
+    """
+
+    with open(os.path.join(download_path, DOWNLOAD_MARKER), 'w', encoding='utf-8') as marker_file:
+        json.dump({'file_regex_list': file_regex_list}, marker_file)
+
+
+def clear_project_downloaded(download_path: str) -> None:
+    """
+    Remove the download marker so the next run downloads the project again
+    download_path: str - Local folder the project was downloaded into
+    """
+
+    marker_path = os.path.join(download_path, DOWNLOAD_MARKER)
+    if os.path.isfile(marker_path):
+        os.remove(marker_path)
 
 
 def main():
@@ -426,9 +648,24 @@ def main():
                 sys.exit(1)
 
             download_path = os.path.join(download_folder, project.id)
-            api.download_files(project.id, download_path, file_regex_list)
             projects_lookup[download_path] = project
 
+        # Skip any project already downloaded by a previous run that hasn't changed on the server since
+        download_lookup = {}
+        for download_path, project in projects_lookup.items():
+            if project_is_downloaded(download_path, project, file_regex_list):
+                log.info(f'Project {project.id} already downloaded and unchanged since. Skipping download.')
+            else:
+                download_lookup[download_path] = project
+
+        # Downloads are network bound so fetch several projects at once
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(api.download_files, project.id, download_path, file_regex_list): download_path for download_path, project in download_lookup.items()}
+            for future in as_completed(futures):
+                future.result()
+                # Only mark the project as downloaded once every one of its files has arrived
+                mark_project_downloaded(futures[future], file_regex_list)
+
         delete_source = answers['delete_source']
 
         merge_projects(projects_lookup, merged_folder, output_name, answers['project_type'], answers['collection_id'], api.stage, file_regex_list, delete_source=delete_source)
@@ -1,6 +1,8 @@
 import os
 import sqlite3
+from contextlib import closing
 
+from shapely.strtree import STRtree
 from rscommons import Logger, ProgressBar, get_shp_or_gpkg, VectorBase
 from rscommons.classes.vector_base import get_utm_zone_epsg
 
@@ -17,12 +19,32 @@ def riverscape_brat(gpkg_path: str, windows: dict):
     reaches = os.path.join(gpkg_path, 'vwReaches')
     dgo = os.path.join(gpkg_path, 'vwDgos')
 
+    # Read every reach attribute needed below in a single query so the spatial loop only
+    # has to deal with reach IDs and geometries rather than pulling fields feature by feature.
+    # ReachID is the FID that OGR exposes for the vwReaches view
+    with closing(sqlite3.connect(gpkg_path)) as reach_conn:
+        reach_curs = reach_conn.execute("""SELECT ReachID, oCC_EX, oCC_HPE, oVC_EX, oVC_HPE, iVeg_30EX, iVeg100EX, iVeg_30HPE, iVeg100HPE,
+                                        Risk, Limitation, Opportunity FROM vwReaches""")
+        reach_values = {row[0]: row[1:] for row in reach_curs.fetchall()}
+
     log.info('Calculating BRAT Outputs on DGOs')
     with get_shp_or_gpkg(dgo) as dgo_lyr:
         long = dgo_lyr.ogr_layer.GetExtent()[0]
         proj_epsg = get_utm_zone_epsg(long)
         sref, transform = VectorBase.get_transform_from_epsg(dgo_lyr.spatial_ref, proj_epsg)
 
+        # Load the reach geometries, already projected to UTM, once into an STRtree. vwReaches is a view with no
+        # spatial index of its own so filtering the layer by each DGO would otherwise scan every reach for every DGO.
+        reach_fids = []
+        reach_geoms = []
+        with get_shp_or_gpkg(reaches) as reach_lyr:
+            for reach_feature, _counter, _progbar in reach_lyr.iterate_features("Loading reach geometries"):
+                if reach_feature.GetGeometryRef() is None:
+                    continue
+                reach_fids.append(reach_feature.GetFID())
+                reach_geoms.append(VectorBase.ogr2shapely(reach_feature, transform))
+        reach_tree = STRtree(reach_geoms)
+
         dgo_atts = {}
         for dgo_feature, _counter, _progbar in dgo_lyr.iterate_features("Processing DGO features"):
             # st = time.time()
@@ -42,46 +64,41 @@ def riverscape_brat(gpkg_path: str, windows: dict):
             hist_num_dams = 0
             ex_veg_dams = 0
             hist_veg_dams = 0
-            lengths = []
-            risk = []
-            limitation = []
-            opportunity = []
-            with get_shp_or_gpkg(reaches) as reach_lyr:
-                for reach_feature, _counter, _progbar in reach_lyr.iterate_features(clip_shape=dgo_geom):
-                    reach_geom = reach_feature.GetGeometryRef()
-                    intersect_geom = reach_geom.Intersection(dgo_geom)
-                    if intersect_geom is not None:
-                        reach_shapely = VectorBase.ogr2shapely(intersect_geom, transform)
-                        reach_length = reach_shapely.length / 1000
-                        ex_density = reach_feature.GetField('oCC_EX')
-                        hist_density = reach_feature.GetField('oCC_HPE')
-                        ex_veg_density = reach_feature.GetField('oVC_EX')
-                        hist_veg_density = reach_feature.GetField('oVC_HPE')
-                        exveg30 = reach_feature.GetField('iVeg_30EX')
-                        exveg100 = reach_feature.GetField('iVeg100EX')
-                        hpeveg30 = reach_feature.GetField('iVeg_30HPE')
-                        hpeveg100 = reach_feature.GetField('iVeg100HPE')
-                        if ex_density is None or hist_density is None:
-                            continue
-                        ex_num_dams += ex_density * reach_length
-                        hist_num_dams += hist_density * reach_length
-                        ex_veg_dams += ex_veg_density * reach_length
-                        hist_veg_dams += hist_veg_density * reach_length
-                        lengths.append(reach_length)
-                        risk.append(reach_feature.GetField('Risk'))
-                        limitation.append(reach_feature.GetField('Limitation'))
-                        opportunity.append(reach_feature.GetField('Opportunity'))
-                        ex30[exveg30] = reach_length
-                        ex100[exveg100] = reach_length
-                        hpe30[hpeveg30] = reach_length
-                        hpe100[hpeveg100] = reach_length
-
-            if len(lengths) > 0:
-                dgo_atts[dgoid] = {'Lengths': sum(lengths)}
-                ix = lengths.index(max(lengths))
-                dgo_atts[dgoid]['Risk'] = risk[ix]
-                dgo_atts[dgoid]['Limitation'] = limitation[ix]
-                dgo_atts[dgoid]['Opportunity'] = opportunity[ix]
+            num_reaches = 0
+            total_length = 0
+            longest_length = None
+            longest_values = None
+            dgo_shapely = VectorBase.ogr2shapely(dgo_geom.Clone(), transform)
+            # Sorting keeps the reaches in layer order, which the longest-reach tie-break below relies on.
+            # Only reaches that actually intersect the DGO count. Reaches whose bounding box overlaps the DGO
+            # but which never touch it contribute no length, so they no longer supply vegetation, Risk,
+            # Limitation or Opportunity values (the OGR spatial filter this replaced let them through)
+            for reach_ix in sorted(reach_tree.query_items(dgo_shapely)):
+                reach_geom = reach_geoms[reach_ix]
+                if reach_geom.intersects(dgo_shapely):
+                    ex_density, hist_density, ex_veg_density, hist_veg_density, exveg30, exveg100, hpeveg30, hpeveg100, \
+                        reach_risk, reach_limitation, reach_opportunity = reach_values[reach_fids[reach_ix]]
+                    if ex_density is None or hist_density is None:
+                        continue
+                    reach_length = reach_geom.intersection(dgo_shapely).length / 1000
+                    ex_num_dams += ex_density * reach_length
+                    hist_num_dams += hist_density * reach_length
+                    ex_veg_dams += ex_veg_density * reach_length
+                    hist_veg_dams += hist_veg_density * reach_length
+                    num_reaches += 1
+                    total_length += reach_length
+                    # Keep the first of the longest reaches without storing every candidate
+                    if longest_length is None or reach_length > longest_length:
+                        longest_length = reach_length
+                        longest_values = (reach_risk, reach_limitation, reach_opportunity)
+                    ex30[exveg30] = reach_length
+                    ex100[exveg100] = reach_length
+                    hpe30[hpeveg30] = reach_length
+                    hpe100[hpeveg100] = reach_length
+
+            if num_reaches > 0:
+                dgo_atts[dgoid] = {'Lengths': total_length}
+                dgo_atts[dgoid]['Risk'], dgo_atts[dgoid]['Limitation'], dgo_atts[dgoid]['Opportunity'] = longest_values
             else:
                 dgo_atts[dgoid] = {'Lengths': 0}
                 dgo_atts[dgoid]['Risk'] = 'NA'
@@ -99,7 +116,7 @@ def riverscape_brat(gpkg_path: str, windows: dict):
                 dgo_atts[dgoid]['oVC_EX'] = 0
                 dgo_atts[dgoid]['oVC_HPE'] = 0
 
-            if len(lengths) > 0:
+            if num_reaches > 0:
                 dgo_atts[dgoid]['mCC_EX_CT'] = ex_num_dams
                 dgo_atts[dgoid]['mCC_HPE_CT'] = hist_num_dams
             else:
@@ -125,22 +142,28 @@ def riverscape_brat(gpkg_path: str, windows: dict):
 
     conn = sqlite3.connect(gpkg_path)
     curs = conn.cursor()
+    # Connection-level tuning for the bulk updates below. WAL is deliberately not used because
+    # the journal mode would persist in the GeoPackage that is distributed with the project.
+    curs.execute('PRAGMA synchronous = NORMAL')
+    curs.execute('PRAGMA temp_store = MEMORY')
+    curs.execute('PRAGMA cache_size = -200000')
 
     log.info('Updating DGO Attributes')
-    progbar = ProgressBar(len(dgo_atts))
-    counter = 0
-    for dgoid, attrs in dgo_atts.items():
-        counter += 1
-        progbar.update(counter)
-        curs.execute(f"""UPDATE DGOAttributes SET oCC_EX = {attrs['oCC_EX']}, oCC_HPE = {attrs['oCC_HPE']}, oVC_EX = {attrs['oVC_EX']}, oVC_HPE = {attrs['oVC_HPE']},
-                        mCC_EX_CT = {attrs['mCC_EX_CT']}, mCC_HPE_CT = {attrs['mCC_HPE_CT']}, iVeg_30EX = {attrs['iVeg_30EX']}, iVeg100EX = {attrs['iVeg100EX']},
-                        iVeg_30HPE = {attrs['iVeg_30HPE']}, iVeg100HPE = {attrs['iVeg100HPE']} WHERE DGOID = {dgoid}""")
-        curs.execute(f"UPDATE DGOAttributes SET Risk = '{attrs['Risk']}', Limitation = '{attrs['Limitation']}', Opportunity = '{attrs['Opportunity']}' WHERE DGOID = {dgoid}")
-        conn.commit()
+    dgo_updates = [(attrs['oCC_EX'], attrs['oCC_HPE'], attrs['oVC_EX'], attrs['oVC_HPE'], attrs['mCC_EX_CT'], attrs['mCC_HPE_CT'],
+                    attrs['iVeg_30EX'], attrs['iVeg100EX'], attrs['iVeg_30HPE'], attrs['iVeg100HPE'],
+                    attrs['Risk'], attrs['Limitation'], attrs['Opportunity'], dgoid) for dgoid, attrs in dgo_atts.items()]
+    curs.executemany("""UPDATE DGOAttributes SET oCC_EX = ?, oCC_HPE = ?, oVC_EX = ?, oVC_HPE = ?, mCC_EX_CT = ?, mCC_HPE_CT = ?,
+                        iVeg_30EX = ?, iVeg100EX = ?, iVeg_30HPE = ?, iVeg100HPE = ?, Risk = ?, Limitation = ?, Opportunity = ? WHERE DGOID = ?""", dgo_updates)
+    conn.commit()
+
+    # Load the DGO attributes the moving windows need in one query rather than two queries per DGO per window
+    curs.execute('SELECT DGOID, centerline_length, oCC_EX, oCC_HPE, oVC_EX, oVC_HPE, Risk, Limitation, Opportunity, segment_area FROM DGOAttributes')
+    dgo_values = {row[0]: row[1:] for row in curs.fetchall()}
 
     log.info('Calculating BRAT Outputs on IGOs (moving window)')
     progbar = ProgressBar(len(windows))
     counter = 0
+    igo_updates = []
     for igoid, dgoids in windows.items():
         counter += 1
         progbar.update(counter)
@@ -149,13 +172,12 @@ def riverscape_brat(gpkg_path: str, windows: dict):
         ex_veg_dams = 0
         hist_veg_dams = 0
         cl_len = 0
-        area = []
-        risk = []
-        limitation = []
-        opportunity = []
+        largest_area = None
+        risk_val = None
+        limitation_val = None
+        opportunity_val = None
         for dgoid in dgoids:
-            curs.execute(f'SELECT centerline_length, oCC_EX, oCC_HPE, oVC_EX, oVC_HPE, Risk, Limitation, Opportunity FROM DGOAttributes WHERE DGOID = {dgoid}')
-            dgoattrs = curs.fetchone()
+            dgoattrs = dgo_values[dgoid]
             if dgoattrs[1] is None:
                 continue
             cl_len += dgoattrs[0]
@@ -163,26 +185,18 @@ def riverscape_brat(gpkg_path: str, windows: dict):
             hist_dams += dgoattrs[0]/1000 * dgoattrs[2]
             ex_veg_dams += dgoattrs[0]/1000 * dgoattrs[3]
             hist_veg_dams += dgoattrs[0]/1000 * dgoattrs[4]
-            risk.append(dgoattrs[5])
-            limitation.append(dgoattrs[6])
-            opportunity.append(dgoattrs[7])
-            curs.execute(f'SELECT segment_area FROM DGOAttributes WHERE DGOID = {dgoid}')
-            area.append(curs.fetchone()[0])
-
-        if len(area) > 0:
-            ix = area.index(max(area))
-            risk_val = risk[ix]
-            limitation_val = limitation[ix]
-            opportunity_val = opportunity[ix]
-        else:
-            risk_val = None
-            limitation_val = None
-            opportunity_val = None
+            # Keep the first of the largest DGOs without storing every candidate
+            if largest_area is None or dgoattrs[8] > largest_area:
+                largest_area = dgoattrs[8]
+                risk_val, limitation_val, opportunity_val = dgoattrs[5:8]
 
         if cl_len > 0:
-            curs.execute(f"""UPDATE IGOAttributes SET oCC_EX = {ex_dams / (cl_len / 1000)}, oCC_HPE = {hist_dams / (cl_len / 1000)},
-                        oVC_EX = {ex_veg_dams / (cl_len / 1000)}, oVC_HPE = {hist_veg_dams / (cl_len / 1000)} WHERE IGOID = {igoid}""")
-            curs.execute(f"UPDATE IGOAttributes SET Risk = '{risk_val}', Limitation = '{limitation_val}', Opportunity = '{opportunity_val}' WHERE IGOID = {igoid}")
-            conn.commit()
+            igo_updates.append((ex_dams / (cl_len / 1000), hist_dams / (cl_len / 1000), ex_veg_dams / (cl_len / 1000), hist_veg_dams / (cl_len / 1000),
+                                risk_val, limitation_val, opportunity_val, igoid))
+
+    log.info('Updating IGO Attributes')
+    curs.executemany("""UPDATE IGOAttributes SET oCC_EX = ?, oCC_HPE = ?, oVC_EX = ?, oVC_HPE = ?,
+                        Risk = ?, Limitation = ?, Opportunity = ? WHERE IGOID = ?""", igo_updates)
+    conn.commit()
     conn.close()
     log.info('BRAT DGO and IGO Outputs Calculated')
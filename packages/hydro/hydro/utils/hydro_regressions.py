@@ -1,15 +1,18 @@
 import argparse
 import sqlite3
 import numpy as np
-from sklearn.linear_model import LinearRegression
 import csv
 import json
 import datetime
 import traceback
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from rscommons import Logger, dotenv, ProgressBar
 
+# Metadata key used to record the R^2 score of each flow equation
+R2_METADATA_KEYS = {'Qlow': 'QLowR2', 'Q2': 'Q2R2'}
+
 
 def generate_linear_regressions(data_dict, x_key, y_key):
     """
@@ -24,222 +27,266 @@ def generate_linear_regressions(data_dict, x_key, y_key):
     Returns:
     dict: Dictionary containing the better model's coefficients, intercept, and R^2 score.
     """
-    if len(data_dict[x_key]) != len(data_dict[y_key]):
-        raise ValueError('The independent and dependent variables must have the same number of values.')
+    model = generate_linear_regressions_multi(data_dict, x_key, [y_key])[y_key]
+    if isinstance(model, ValueError):
+        raise model
+    return model
+
+
+def generate_linear_regressions_multi(data_dict, x_key, y_keys):
+    """
+    Generate the better of the regular and log-transformed linear regression models for several
+    dependent variables that share the same independent variable. All the dependent variables are
+    fitted together so the independent variable is only filtered and log-transformed once, but each
+    one is validated on its own so data unsuitable for one variable doesn't prevent fitting the others.
+
+    Parameters:
+    data_dict (dict): Dictionary containing the data.
+    x_key (str): Key to be used as the independent variable.
+    y_keys (list): Keys to be used as the dependent variables.
+
+    Returns:
+    dict: Dictionary keyed by y_key of the better model's coefficients, intercept, and R^2 score,
+        or the ValueError explaining why that variable could not be fitted.
+    """
     if len(data_dict[x_key]) < 3:
         raise ValueError('At least 3 data points are required to generate a linear regression model.')
 
-    # Extract data from the dictionary
-    X = np.array(data_dict[x_key]).reshape(-1, 1)
-    y = np.array(data_dict[y_key])
-    # Find indices where X is 0
-    zero_indices = np.where(X == 0)[0]
-
-    # Remove these indices from X and y
-    X = np.delete(X, zero_indices, axis=0)
-    y = np.delete(y, zero_indices, axis=0)
-
-    # Create and train the regular linear regression model
-    model_regular = LinearRegression(fit_intercept=False)
-    model_regular.fit(X, y)
-    r2_regular = model_regular.score(X, y)
-
-    # Create and train the log-transformed linear regression model
-    X_log = np.log10(X)
-    y_log = np.log10(y)
-    model_log = LinearRegression()
-    model_log.fit(X_log, y_log)
-    r2_log = model_log.score(X_log, y_log)
-
-    # Compare R^2 scores and return the better model
-    if r2_regular >= r2_log:
-        return {
-            'model_type': 'regular',
-            'coefficients': model_regular.coef_,
-            'intercept': model_regular.intercept_,
-            'r2_score': r2_regular
-        }
-    else:
-        return {
-            'model_type': 'log-transformed',
-            'coefficients': model_log.coef_,
-            'intercept': model_log.intercept_,
-            'r2_score': r2_log
-        }
-
-
-def update_csv_rows(file_path, target_column, target_value, update_column, update_value):
+    models = {}
+    fit_keys = []
+    for y_key in y_keys:
+        if len(data_dict[x_key]) != len(data_dict[y_key]):
+            models[y_key] = ValueError('The independent and dependent variables must have the same number of values.')
+        else:
+            fit_keys.append(y_key)
+    if len(fit_keys) == 0:
+        return models
+
+    # Extract data from the dictionary, with one column per dependent variable
+    X = np.array(data_dict[x_key], dtype=float)
+    Y = np.column_stack([np.array(data_dict[y_key], dtype=float) for y_key in fit_keys])
+
+    # Remove the values where X is 0
+    nonzero = X != 0
+    X = X[nonzero]
+    Y = Y[nonzero]
+
+    # Fit the regular linear regression models through the origin, and the log-transformed linear regression
+    # models (slope and intercept), using the closed form least squares solutions. Every operation works
+    # column by column so a column that cannot be fitted only produces non-finite values in its own results
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope_regular = (X @ Y) / (X @ X)
+        r2_regular = r2_score(Y, np.outer(X, slope_regular))
+
+        X_log = np.log10(X)
+        Y_log = np.log10(Y)
+        x_dev = X_log - X_log.mean()
+        slope_log = (x_dev @ (Y_log - Y_log.mean(axis=0))) / (x_dev @ x_dev)
+        intercept_log = Y_log.mean(axis=0) - slope_log * X_log.mean()
+        r2_log = r2_score(Y_log, intercept_log + np.outer(X_log, slope_log))
+
+    # Compare R^2 scores and keep the better model for each dependent variable
+    for idx, y_key in enumerate(fit_keys):
+        # A zero or negative value has no logarithm so the data cannot be used for a log-transformed model
+        if not np.isfinite(X_log).all() or not np.isfinite(Y_log[:, idx]).all():
+            models[y_key] = ValueError(f'The {y_key} data contains zero or negative values so a log-transformed model cannot be generated.')
+            continue
+
+        # Degenerate data (e.g. every gage with the same drainage area) produces undefined fits
+        if not all(np.isfinite(fitted[idx]) for fitted in (slope_regular, r2_regular, slope_log, intercept_log, r2_log)):
+            models[y_key] = ValueError(f'The {y_key} data does not produce a finite linear regression model.')
+            continue
+
+        if r2_regular[idx] >= r2_log[idx]:
+            models[y_key] = {
+                'model_type': 'regular',
+                'coefficients': np.array([slope_regular[idx]]),
+                'intercept': 0.0,
+                'r2_score': r2_regular[idx]
+            }
+        else:
+            models[y_key] = {
+                'model_type': 'log-transformed',
+                'coefficients': np.array([slope_log[idx]]),
+                'intercept': intercept_log[idx],
+                'r2_score': r2_log[idx]
+            }
+    return {y_key: models[y_key] for y_key in y_keys}
+
+
+def r2_score(y, y_pred):
     """
-    Update rows in a CSV file where the target column matches the target value.
+    Calculate the coefficient of determination (R^2) of a set of predictions.
 
     Parameters:
-    file_path (str): Path to the CSV file.
-    target_column (str): Name of the column to be checked for the target value.
-    target_value (str): The value to be matched in the target column.
-    new_value (str): The new value to be set in the target column.
+    y (np.ndarray): The observed values, with one column per variable.
+    y_pred (np.ndarray): The predicted values, with one column per variable.
 
     Returns:
-    None
+    np.ndarray: The R^2 score of each column.
     """
-    # Read the CSV file
-    with open(file_path, mode='r', newline='') as file:
-        reader = csv.DictReader(file)
-        rows = list(reader)
-        fieldnames = reader.fieldnames
+    ss_res = ((y - y_pred) ** 2).sum(axis=0)
+    ss_tot = ((y - y.mean(axis=0)) ** 2).sum(axis=0)
+    return 1 - ss_res / ss_tot
 
-    # Update the rows
-    for row in rows:
-        if row[target_column] == target_value:
-            row[update_column] = update_value
 
-    # Write the updated rows back to the CSV file
-    with open(file_path, mode='w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+def generate_gage_data(db_path, huc, minimum_gages):
+    """
+    Gather the drainage area and discharges of the valid gages in a HUC, stepping up to
+    the HUC6, HUC4 and then HUC2 that contains it until there are at least minimum_gages.
 
+    Parameters:
+    db_path (str): Path to the SQLite database containing the gage data.
+    huc (str): The HUC8 to gather gages for.
+    minimum_gages (int): The minimum number of gages needed for a regression.
 
-def generate_gage_data(db_path, huc, minimum_gages):
+    Returns:
+    tuple: Dictionary of DA, Qlow and Q2 lists, the number of gages and the HUC level they came from.
+    """
 
-    conn = sqlite3.connect(db_path)
-    curs = conn.cursor()
-
-    out_data = {'DA': [], 'Qlow': [], 'Q2': []}
-
-    # select hucs whose hucs = huc
-    curs.execute(f"SELECT da, min_discharge, peak_discharge FROM sites LEFT JOIN discharges on sites.site_no = discharges.site_no WHERE huc = '{huc}' and is_valid = 1")
-    selection = curs.fetchall()
-    selection = [gage for gage in selection if None not in gage]
-    if len(selection) >= minimum_gages:
-        for gage in selection:
-            out_data['DA'].append(gage[0])
-            out_data['Qlow'].append(gage[1])
-            out_data['Q2'].append(gage[2])
-        level = 8
-        if None in out_data:
-            print('here')
-        return out_data, len(selection), level
-    else:
-        # step up to huc6 and add to select huc[0:6] = huc[0:6]
-        curs.execute(f"SELECT da, min_discharge, peak_discharge FROM sites LEFT JOIN discharges on sites.site_no = discharges.site_no WHERE SUBSTR(huc, 0, 7) = '{huc[:6]}' and is_valid = 1")
-        selection = curs.fetchall()
-        selection = [gage for gage in selection if None not in gage]
+    # Every candidate gage lies within the HUC2 so fetch them all in one query and narrow them down in memory
+    with sqlite3.connect(db_path) as conn:
+        conn.row_factory = sqlite3.Row
+        curs = conn.cursor()
+        curs.execute("""SELECT huc, da, min_discharge, peak_discharge FROM sites LEFT JOIN discharges on sites.site_no = discharges.site_no
+                     WHERE huc LIKE ? and is_valid = 1""", [f'{huc[:2]}%'])
+        gages = [gage for gage in curs.fetchall() if None not in gage]
+    conn.close()
+
+    for level in (8, 6, 4, 2):
+        selection = [gage for gage in gages if gage['huc'][:level] == huc[:level]]
         if len(selection) >= minimum_gages:
-            for gage in selection:
-                out_data['DA'].append(gage[0])
-                out_data['Qlow'].append(gage[1])
-                out_data['Q2'].append(gage[2])
-            level = 6
-            if None in out_data:
-                print('here')
+            out_data = {
+                'DA': [gage['da'] for gage in selection],
+                'Qlow': [gage['min_discharge'] for gage in selection],
+                'Q2': [gage['peak_discharge'] for gage in selection]
+            }
             return out_data, len(selection), level
-        else:
-            # step up to huc4 and add to selection huc[0:4] = huc[0:4]
-            curs.execute(f"SELECT da, min_discharge, peak_discharge FROM sites LEFT JOIN discharges on sites.site_no = discharges.site_no WHERE SUBSTR(huc, 0, 5) = '{huc[:4]}' and is_valid = 1")
-            selection = curs.fetchall()
-            selection = [gage for gage in selection if None not in gage]
-            if len(selection) >= minimum_gages:
-                for gage in selection:
-                    out_data['DA'].append(gage[0])
-                    out_data['Qlow'].append(gage[1])
-                    out_data['Q2'].append(gage[2])
-                level = 4
-                if None in out_data:
-                    print('here')
-                return out_data, len(selection), level
-            else:
-                # step up to huc2 and add to selection huc[0:2] = huc[0:2]
-                curs.execute(f"SELECT da, min_discharge, peak_discharge FROM sites LEFT JOIN discharges on sites.site_no = discharges.site_no WHERE SUBSTR(huc, 0, 3) = '{huc[:2]}' and is_valid = 1")
-                selection = curs.fetchall()
-                selection = [gage for gage in selection if None not in gage]
-                if len(selection) >= minimum_gages:
-                    for gage in selection:
-                        out_data['DA'].append(gage[0])
-                        out_data['Qlow'].append(gage[1])
-                        out_data['Q2'].append(gage[2])
-                    level = 2
-                    if None in out_data:
-                        print('here')
-                    return out_data, len(selection), level
-                else:
-                    raise ValueError(f"Insufficient gages for HUC {huc}")
+
+    raise ValueError(f"Insufficient gages for HUC {huc}")
 
 
 def update_watersheds_table(csv_path, db_path, operator):
 
     log = Logger('Flow Equations')
 
-    metadata = {}
-
-    # get list of huc8s from watersheds table
+    # Load the watersheds table once. Rows are updated in memory and the CSV is written back a single time
     with open(csv_path, mode='r', newline='') as file:
         reader = csv.DictReader(file)
-        huc8s_qlow = [row['WatershedID'] for row in reader if row['Qlow'] == '']
-        log.info(f"Updating {len(huc8s_qlow)} watersheds with missing Qlow values.")
-    with open(csv_path, mode='r', newline='') as file:
-        reader = csv.DictReader(file)
-        huc8s_q2 = [row['WatershedID'] for row in reader if row['Q2'] == '']
-        log.info(f"Updating {len(huc8s_q2)} watersheds with missing Q2 values.")
+        rows = list(reader)
+        fieldnames = reader.fieldnames
+    watersheds = {row['WatershedID']: row for row in rows}
+
+    # get list of huc8s from watersheds table
+    huc8s_qlow = []
+    huc8s_q2 = []
+    for row in rows:
+        if row['Qlow'] == '':
+            huc8s_qlow.append(row['WatershedID'])
+        if row['Q2'] == '':
+            huc8s_q2.append(row['WatershedID'])
+    log.info(f"Updating {len(huc8s_qlow)} watersheds with missing Qlow values.")
+    log.info(f"Updating {len(huc8s_q2)} watersheds with missing Q2 values.")
+
+    try:
+        update_watershed_rows(watersheds, huc8s_qlow, huc8s_q2, db_path, operator)
+    finally:
+        # Write whatever was calculated, even if a watershed fails part way through
+        with open(csv_path, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def fit_flow_equations(huc, db_path, fit_qlow, fit_q2):
+    """
+    Fit the Qlow and/or Q2 regressions for a single watershed. This runs in a worker process
+    so it only relies on its arguments and opens its own connection to the gage database.
+
+    Parameters:
+    huc (str): The WatershedID (HUC8) to fit.
+    db_path (str): Path to the SQLite database containing the gage data.
+    fit_qlow (bool): Whether to fit the Qlow regression.
+    fit_q2 (bool): Whether to fit the Q2 regression.
+
+    Returns:
+    tuple: Dictionary keyed by 'Qlow'/'Q2' of the fitted model, or the ValueError raised while fitting it,
+        the number of gages and the HUC level they came from.
+    """
+    data, gage_ct, huc_level = generate_gage_data(db_path, huc, 5)
+    y_keys = [y_key for y_key, fit in (('Qlow', fit_qlow), ('Q2', fit_q2)) if fit]
+
+    # Each equation gets its own model or ValueError so data unsuitable for one (e.g. a zero low flow) doesn't lose the other
+    models = generate_linear_regressions_multi(data, 'DA', y_keys)
+    return models, gage_ct, huc_level
+
+
+def flow_equation(model):
+    """
+    Build the flow equation string for a regression model returned by generate_linear_regressions.
+
+    Parameters:
+    model (dict): The regression model.
+
+    Returns:
+    str: The equation in terms of DRNAREA.
+    """
+    if model['model_type'] == 'regular':
+        return f"{model['coefficients'][0]} * DRNAREA"
+    return f"{10 ** model['intercept']} * DRNAREA ** {model['coefficients'][0]}"
+
+
+def update_watershed_rows(watersheds, huc8s_qlow, huc8s_q2, db_path, operator):
+    """
+    Calculate the Qlow and Q2 flow equations for the watersheds that are missing them.
+    Each watershed is independent so they are fitted concurrently in a pool of processes.
+
+    Parameters:
+    watersheds (dict): Watersheds table rows keyed by WatershedID. Updated in place.
+    huc8s_qlow (list): WatershedIDs missing a Qlow equation.
+    huc8s_q2 (list): WatershedIDs missing a Q2 equation.
+    db_path (str): Path to the SQLite database containing the gage data.
+    operator (str): The person updating the flow equations.
+
+    Returns:
+    None
+    """
+
+    log = Logger('Flow Equations')
+
+    # One job per watershed, fitting whichever of Qlow and Q2 it is missing
+    qlow_hucs = set(huc8s_qlow)
+    q2_hucs = set(huc8s_q2)
+    hucs = huc8s_qlow + [huc for huc in huc8s_q2 if huc not in qlow_hucs]
 
-    progbar = ProgressBar(len(huc8s_qlow), 50, 'Updating watersheds')
+    progbar = ProgressBar(len(hucs), 50, 'Updating watersheds')
     counter = 0
-    for huc in huc8s_qlow:
-        try:
-            data, gage_ct, huc_level = generate_gage_data(db_path, huc, 5)
-            qlow = generate_linear_regressions(data, 'DA', 'Qlow')
-            if huc in huc8s_q2:
-                q2 = generate_linear_regressions(data, 'DA', 'Q2')
-                huc8s_q2.remove(huc)
-            else:
-                q2_r2 = None
-
-            if qlow['model_type'] == 'regular':
-                qlow_eqn = f"{qlow['coefficients'][0]} * DRNAREA"
-                qlow_r2 = qlow['r2_score']
-            else:
-                qlow_eqn = f"{10 ** qlow['intercept']} * DRNAREA ** {qlow['coefficients'][0]}"
-                qlow_r2 = qlow['r2_score']
-            if q2['model_type'] == 'regular':
-                q2_eqn = f"{q2['coefficients'][0]} * DRNAREA"
-                q2_r2 = q2['r2_score']
-            else:
-                q2_eqn = f"{10 ** q2['intercept']} * DRNAREA ** {q2['coefficients'][0]}"
-                q2_r2 = q2['r2_score']
-
-            metadata[huc] = {'Operator': operator, 'DateCreated': datetime.datetime.now().isoformat(), 'NumGages': gage_ct, 'HucLevel': huc_level, 'QLowR2': qlow_r2, 'Q2R2': q2_r2}
-
-            update_csv_rows(csv_path, 'WatershedID', huc, 'Qlow', qlow_eqn)  # is it going to be slow doing this one by one?
-            update_csv_rows(csv_path, 'WatershedID', huc, 'Q2', q2_eqn)
-            update_csv_rows(csv_path, 'WatershedID', huc, 'Metadata', json.dumps(metadata[huc]))
-
-        except ValueError as e:
-            log.error(e)
-
-        counter += 1
-        progbar.update(counter)
-
-    for huc in huc8s_q2:
-        try:
-            data, gage_ct, huc_level = generate_gage_data(db_path, huc, 5)
-            q2 = generate_linear_regressions(data, 'DA', 'Q2')
-            if q2['model_type'] == 'regular':
-                q2_eqn = f"{q2['intercept']} + {q2['coefficients'][0]} * DRNAREA"
-                q2_r2 = q2['r2_score']
-            else:
-                q2_eqn = f"{10 ** q2['intercept']} * DRNAREA ** {q2['coefficients'][0]}"
-                q2_r2 = q2['r2_score']
-
-            update_csv_rows(csv_path, 'WatershedID', huc, 'Q2', q2_eqn)
-            if huc in metadata.keys():
-                metadata[huc]['Q2R2'] = q2_r2
-            else:
-                metadata[huc] = {'Operator': operator, 'DateCreated': datetime.datetime.now().isoformat(), 'NumGages': gage_ct, 'HucLevel': huc_level, 'Q2R2': q2_r2}
-
-            update_csv_rows(csv_path, 'WatershedID', huc, 'Q2', q2_eqn)
-            update_csv_rows(csv_path, 'WatershedID', huc, 'Metadata', json.dumps(metadata[huc]))
-        
-        except ValueError as e:
-            log.error(e)
+    with ProcessPoolExecutor() as executor:
+        futures = {executor.submit(fit_flow_equations, huc, db_path, huc in qlow_hucs, huc in q2_hucs): huc for huc in hucs}
+        for future in as_completed(futures):
+            huc = futures[future]
+            try:
+                models, gage_ct, huc_level = future.result()
+
+                metadata = {'Operator': operator, 'DateCreated': datetime.datetime.now().isoformat(), 'NumGages': gage_ct, 'HucLevel': huc_level}
+                fitted = False
+                for y_key, model in models.items():
+                    if isinstance(model, ValueError):
+                        log.error(f'{y_key} for HUC {huc}: {model}')
+                        continue
+                    watersheds[huc][y_key] = flow_equation(model)
+                    metadata[R2_METADATA_KEYS[y_key]] = model['r2_score']
+                    fitted = True
+                metadata.setdefault('Q2R2', None)
+
+                if fitted:
+                    watersheds[huc]['Metadata'] = json.dumps(metadata)
+
+            except ValueError as e:
+                log.error(e)
+
+            counter += 1
+            progbar.update(counter)
 
 
 def main():
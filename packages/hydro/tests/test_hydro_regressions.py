@@ -0,0 +1,89 @@
+""" Testing for the flow equation regressions
+
+"""
+import unittest
+import numpy as np
+from hydro.utils.hydro_regressions import generate_linear_regressions, generate_linear_regressions_multi
+
+
+class HydroRegressionsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.da = rng.uniform(1, 100, 20)
+        self.data = {
+            'DA': list(self.da),
+            'Qlow': list(3 * self.da ** 0.7 * rng.uniform(0.9, 1.1, 20)),
+            'Q2': list(2 * self.da * rng.uniform(0.95, 1.05, 20))
+        }
+
+    def test_log_transformed(self):
+        """Power law data is best fitted by the log-transformed model
+        """
+        model = generate_linear_regressions(self.data, 'DA', 'Qlow')
+        slope, intercept = np.polyfit(np.log10(self.data['DA']), np.log10(self.data['Qlow']), 1)
+
+        self.assertEqual(model['model_type'], 'log-transformed')
+        self.assertAlmostEqual(model['coefficients'][0], slope)
+        self.assertAlmostEqual(model['intercept'], intercept)
+        self.assertGreater(model['r2_score'], 0.95)
+
+    def test_regular(self):
+        """Proportional data is best fitted by the regular model through the origin
+        """
+        data = {'DA': [1.0, 2.0, 3.0, 4.0, 10.0], 'Q2': [2.0, 4.1, 5.9, 8.0, 20.0]}
+        model = generate_linear_regressions(data, 'DA', 'Q2')
+        da = np.array(data['DA'])
+        q2 = np.array(data['Q2'])
+
+        self.assertEqual(model['model_type'], 'regular')
+        self.assertAlmostEqual(model['coefficients'][0], (da @ q2) / (da @ da))
+        self.assertEqual(model['intercept'], 0.0)
+
+    def test_multi_matches_single(self):
+        """Fitting several columns together gives the same models as fitting them one at a time
+        """
+        models = generate_linear_regressions_multi(self.data, 'DA', ['Qlow', 'Q2'])
+        for y_key in ['Qlow', 'Q2']:
+            model = generate_linear_regressions(self.data, 'DA', y_key)
+            self.assertEqual(models[y_key]['model_type'], model['model_type'])
+            self.assertAlmostEqual(models[y_key]['coefficients'][0], model['coefficients'][0])
+            self.assertAlmostEqual(models[y_key]['intercept'], model['intercept'])
+            self.assertAlmostEqual(models[y_key]['r2_score'], model['r2_score'])
+
+    def test_zero_drainage_area(self):
+        """Gages with zero drainage area are ignored
+        """
+        data = {'DA': self.data['DA'] + [0], 'Qlow': self.data['Qlow'] + [5]}
+        self.assertAlmostEqual(generate_linear_regressions(data, 'DA', 'Qlow')['r2_score'],
+                               generate_linear_regressions(self.data, 'DA', 'Qlow')['r2_score'])
+
+    def test_zero_discharge(self):
+        """A zero discharge cannot be log-transformed so that column has no model but the others are still fitted
+        """
+        data = {**self.data, 'Qlow': [0.0] + self.data['Qlow'][1:]}
+        with self.assertRaises(ValueError):
+            generate_linear_regressions(data, 'DA', 'Qlow')
+
+        models = generate_linear_regressions_multi(data, 'DA', ['Qlow', 'Q2'])
+        self.assertIsInstance(models['Qlow'], ValueError)
+        q2 = generate_linear_regressions(self.data, 'DA', 'Q2')
+        self.assertEqual(models['Q2']['model_type'], q2['model_type'])
+        self.assertAlmostEqual(models['Q2']['coefficients'][0], q2['coefficients'][0])
+        self.assertAlmostEqual(models['Q2']['r2_score'], q2['r2_score'])
+
+    def test_constant_discharge(self):
+        """A constant discharge has no defined R^2 so that column has no model but the others are still fitted
+        """
+        data = {**self.data, 'Q2': [5.0] * len(self.data['DA'])}
+        models = generate_linear_regressions_multi(data, 'DA', ['Qlow', 'Q2'])
+        self.assertIsInstance(models['Q2'], ValueError)
+        self.assertEqual(models['Qlow']['model_type'], 'log-transformed')
+
+    def test_too_few_gages(self):
+        with self.assertRaises(ValueError):
+            generate_linear_regressions({'DA': [1, 2], 'Qlow': [1, 2]}, 'DA', 'Qlow')
+
+
+if __name__ == '__main__':
+    unittest.main()
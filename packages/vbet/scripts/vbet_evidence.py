@@ -9,9 +9,12 @@ from csv import DictWriter
 from math import floor
 
 from osgeo import gdal, ogr
+from shapely.strtree import STRtree
 
-from rscommons import GeopackageLayer, get_shp_or_gpkg
+from rscommons import GeopackageLayer, get_shp_or_gpkg, VectorBase
 
+# Number of observation rows buffered before they are written to the CSV
+WRITE_BATCH_SIZE = 1000
 
 attributes = {'HAND': 'outputs/HAND.tif',
               'Slope': 'outputs/gdal_slope.tif'}
@@ -53,64 +56,92 @@ def extract_vbet_evidence(observation_points, vbet_data_root, out_points, hucid)
     else:
         csv_mode = 'w'
 
-    with open(out_points, csv_mode, newline='') as csvfile, \
+    # Open each evidence raster once rather than once for every observation point
+    rasters = {}
+    for attribute, path in attributes.items():
+        raster_path = os.path.join(vbet_data_root, 'taudem', hucid, path)
+        if os.path.exists(raster_path):
+            src_ds = gdal.Open(raster_path)
+            rasters[attribute] = (src_ds, src_ds.GetGeoTransform(), src_ds.GetRasterBand(1))
+
+    catchments_path = os.path.join(vbet_data_root, 'rs_context', hucid, 'hydrology', 'NHDPlusCatchment.shp')
+    flowlines_path = os.path.join(vbet_data_root, 'rs_context', hucid, 'hydrology', 'nhd_data.sqlite')
+
+    # Catchments are only looked up for points with both HAND and Slope values, so the
+    # RS Context hydrology is only needed when both rasters exist for this HUC
+    conn = None
+    catchment_ids = []
+    catchment_geoms = []
+    catchment_tree = None
+    if 'HAND' in rasters and 'Slope' in rasters:
+        # Load the catchments into an STRtree once rather than filtering the shapefile for every observation point
+        with get_shp_or_gpkg(catchments_path) as catchments:
+            for catchment_feat, *_ in catchments.iterate_features():
+                if catchment_feat.GetGeometryRef() is None:
+                    continue
+                catchment_ids.append(catchment_feat.GetField('NHDPlusID'))
+                catchment_geoms.append(VectorBase.ogr2shapely(catchment_feat))
+        catchment_tree = STRtree(catchment_geoms)
+
+        # Read only so that a missing database raises an error instead of being created empty
+        conn = sqlite3.connect(f'file:{flowlines_path}?mode=ro', uri=True)
+
+    with open(out_points, csv_mode, newline='', buffering=1 << 20) as csvfile, \
             GeopackageLayer(observation_points) as in_points:
 
         writer = DictWriter(csvfile, [n for n in observation_fields] + ['category_name', 'StreamOrder', 'DrainageAreaSqkm', 'InputZone'] + [n for n in attributes])
         if csv_mode == 'w':
             writer.writeheader()
 
+        rows = []
         for feat, *_ in in_points.iterate_features():
             feat_attributes = {name: feat.GetField(name) for name in observation_fields}
             feat_attributes['category_name'] = category_lookup[feat_attributes['categoryid']]
             geom = feat.GetGeometryRef()
 
-            for attribute, path in attributes.items():
-                raster_path = os.path.join(vbet_data_root, 'taudem', hucid, path)
-                if os.path.exists(raster_path):
-                    src_ds = gdal.Open(raster_path)
-                    gt = src_ds.GetGeoTransform()
-                    rb = src_ds.GetRasterBand(1)
-
-                    mx, my = geom.GetX(), geom.GetY()  # coord in map units
-                    if gt[0] <= mx <= (gt[0] + gt[1] * rb.XSize) and gt[3] >= my >= (gt[3] + gt[5] * rb.YSize):
-
-                        # Convert from map to pixel coordinates.
-                        # Only works for geotransforms with no rotation.
-                        px = floor((mx - gt[0]) / gt[1])  # x pixel
-                        py = floor((my - gt[3]) / gt[5])  # y pixel
-
-                        intval = rb.ReadAsArray(px, py, 1, 1)
-                        if intval is not None:
-                            value = float(intval[0][0])
-                            feat_attributes[attribute] = value
-                    else:
-                        continue
-
-            if 'HAND' and 'Slope' in feat_attributes.keys():
-                catchments_path = os.path.join(vbet_data_root, 'rs_context', hucid, 'hydrology', 'NHDPlusCatchment.shp')
-                flowlines_path = os.path.join(vbet_data_root, 'rs_context', hucid, 'hydrology', 'nhd_data.sqlite')
-
-                with get_shp_or_gpkg(catchments_path) as catchments:
+            mx, my = geom.GetX(), geom.GetY()  # coord in map units
+            for attribute, (_src_ds, gt, rb) in rasters.items():
+                if gt[0] <= mx <= (gt[0] + gt[1] * rb.XSize) and gt[3] >= my >= (gt[3] + gt[5] * rb.YSize):
 
-                    for catchment_feat, *_ in catchments.iterate_features(clip_shape=geom):
-                        nhd_id = catchment_feat.GetField('NHDPlusID')
+                    # Convert from map to pixel coordinates.
+                    # Only works for geotransforms with no rotation.
+                    px = floor((mx - gt[0]) / gt[1])  # x pixel
+                    py = floor((my - gt[3]) / gt[5])  # y pixel
 
-                        with sqlite3.connect(flowlines_path) as conn:
+                    intval = rb.ReadAsArray(px, py, 1, 1)
+                    if intval is not None:
+                        value = float(intval[0][0])
+                        feat_attributes[attribute] = value
 
-                            curs = conn.cursor()
-                            if len(curs.execute('select * from NHDPlusFlowlineVAA where NHDPlusID = ?', (nhd_id,)).fetchall()) > 0:
-                                feat_attributes['StreamOrder'] = curs.execute('select StreamOrde from NHDPlusFlowlineVAA where NHDPlusID = ?', (nhd_id,)).fetchall()[0][0]
-                                feat_attributes['DrainageAreaSqkm'] = curs.execute('select TotDASqKm from NHDPlusFlowlineVAA where NHDPlusID = ?', (nhd_id,)).fetchall()[0][0]
-
-                                if feat_attributes['StreamOrder'] < 2:
-                                    feat_attributes['InputZone'] = 'Small'
-                                elif feat_attributes['StreamOrder'] < 4:
-                                    feat_attributes['InputZone'] = "Medium"
-                                else:
-                                    feat_attributes['InputZone'] = 'Large'
-
-                writer.writerow(feat_attributes)
+            if 'HAND' in feat_attributes and 'Slope' in feat_attributes:
+                point = VectorBase.ogr2shapely(geom)
+                for catchment_ix in sorted(catchment_tree.query_items(point)):
+                    if not catchment_geoms[catchment_ix].intersects(point):
+                        continue
+                    nhd_id = catchment_ids[catchment_ix]
+
+                    row = conn.execute('SELECT StreamOrde, TotDASqKm FROM NHDPlusFlowlineVAA WHERE NHDPlusID = ?', (nhd_id,)).fetchone()
+                    if row is not None:
+                        feat_attributes['StreamOrder'], feat_attributes['DrainageAreaSqkm'] = row
+
+                        if feat_attributes['StreamOrder'] < 2:
+                            feat_attributes['InputZone'] = 'Small'
+                        elif feat_attributes['StreamOrder'] < 4:
+                            feat_attributes['InputZone'] = "Medium"
+                        else:
+                            feat_attributes['InputZone'] = 'Large'
+
+                rows.append(feat_attributes)
+                if len(rows) >= WRITE_BATCH_SIZE:
+                    writer.writerows(rows)
+                    rows.clear()
+
+        writer.writerows(rows)
+
+    # Close the rasters and the flowlines database
+    if conn is not None:
+        conn.close()
+    rasters.clear()
 
 
 def main():
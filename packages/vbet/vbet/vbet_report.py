@@ -30,19 +30,13 @@ class VBETReport(RSReport):
         # self.transforms()
 
     def report_intro(self):
-        realization = self.xml_project.XMLBuilder.find('Realizations').find('Realization')
+        realization = self.xml_project.XMLBuilder.find('Realizations/Realization')
 
-        section_in = self.section('Inputs', 'Inputs')
-        inputs = list(realization.find('Inputs'))
-        [self.layerprint(lyr, section_in, self.project_root) for lyr in inputs if lyr.tag in ['DEM', 'Raster', 'Vector', 'Geopackage']]
-
-        section_inter = self.section('Intermediates', 'Intermediates')
-        intermediates = list(realization.find('Intermediates'))
-        [self.layerprint(lyr, section_inter, self.project_root) for lyr in intermediates if lyr.tag in ['DEM', 'Raster', 'Vector', 'Geopackage']]
-
-        section_out = self.section('Outputs', 'Outputs')
-        outputs = list(realization.find('Outputs'))
-        [self.layerprint(lyr, section_out, self.project_root) for lyr in outputs if lyr.tag in ['DEM', 'Raster', 'Vector', 'Geopackage']]
+        for section_name in ['Inputs', 'Intermediates', 'Outputs']:
+            section = self.section(section_name, section_name)
+            for lyr in realization.find(section_name):
+                if lyr.tag in ['DEM', 'Raster', 'Vector', 'Geopackage']:
+                    self.layerprint(lyr, section, self.project_root)
 
     def transforms(self):
         section = self.section("Report Intro", "Transforms")